@@ -1,13 +1,33 @@
-import os, base64, json, yaml, re
+import os, base64, json, yaml, re, hashlib
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import streamlit as st
 import sqlite3
-import pandas as pd
 import base64
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
+
+try:
+    import tomllib
+except ModuleNotFoundError:  # Python < 3.11
+    import tomli as tomllib
+
+try:
+    import orjson
+
+    json_dumps, json_loads = orjson.dumps, orjson.loads
+except ModuleNotFoundError:  # orjson ist optional, stdlib json als Fallback
+
+    def json_dumps(obj):
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+
+    json_loads = json.loads
+
 from dotenv import load_dotenv, find_dotenv
-import markdown
-import markdown2
+import mistune
 import yaml
 
 
@@ -20,7 +40,8 @@ import streamlit_authenticator as stauth
 st.set_page_config(page_title="B2B KI-Research & Analyse", layout="wide")
 
 
-from weasyprint import HTML
+from weasyprint import HTML, CSS
+from weasyprint.text.fonts import FontConfiguration
 
 # ------------------ CONFIG ------------------
 load_dotenv()
@@ -31,9 +52,14 @@ PERPLEXITY_MODEL = os.getenv("PERPLEXITY_MODEL", "sonar-pro")
 OPENROUTER_RATE = float(os.getenv("OPENROUTER_RATE_PER_1K", "0.005"))
 PERPLEXITY_RATE = float(os.getenv("PERPLEXITY_RATE_PER_1K", "0.01"))
 APP_VERSION = os.getenv("VERSION")
+ANALYSIS_CACHE_TTL = int(os.getenv("ANALYSIS_CACHE_TTL", "86400"))  # Sekunden
 
 
 # ---------- AUTH CONFIG LOADING ----------
+# libyaml-Loader, falls PyYAML mit C-Bindings gebaut ist (gleiche Safe-Semantik)
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
 def _maybe_unescape_newlines(s: str) -> str:
     # Wenn keine echten NLs enthalten sind, aber \n-Seq., dann ent-escapen
     if "\n" not in s and "\\n" in s:
@@ -50,9 +76,15 @@ def _maybe_strip_quotes(s: str) -> str:
     return s
 
 
+_B64_RE = re.compile(r"[A-Za-z0-9+/=\s]+")
+
+
 def _maybe_b64_decode(s: str) -> str:
     # Heuristik: Base64? (nur gültige Base64-Zeichen und Länge mehrfach von 4)
-    if re.fullmatch(r"[A-Za-z0-9+/=\s]+", s) and len(s.strip()) % 4 == 0:
+    # YAML/JSON enthalten immer ":", Base64 nie – schneller Ausschluss vor dem Regex
+    if ":" in s:
+        return s
+    if len(s.strip()) % 4 == 0 and _B64_RE.fullmatch(s):
         try:
             return base64.b64decode(s).decode("utf-8")
         except Exception:
@@ -68,7 +100,12 @@ def load_auth_config():
             return None
         with open(path, "r", encoding="utf-8") as f:
             raw = f.read()
+    return parse_auth_config(raw)
+
 
+@st.cache_resource(show_spinner=False)
+def parse_auth_config(raw):
+    """Normalize, parse and validate the auth config once per distinct raw text"""
     # Robustheit für Render/Secrets
     raw = _maybe_strip_quotes(raw)
     raw = _maybe_unescape_newlines(raw)
@@ -77,7 +114,9 @@ def load_auth_config():
     try:
         # YAML oder JSON erlauben
         cfg = (
-            yaml.safe_load(raw) if not raw.strip().startswith("{") else json.loads(raw)
+            yaml.load(raw, Loader=YAML_LOADER)
+            if not raw.strip().startswith("{")
+            else json.loads(raw)
         )
 
         if not isinstance(cfg, dict):
@@ -162,166 +201,296 @@ name = st.session_state.name
 
 # --- Rate Limiting ---
 import time
+import logging
+import uuid
+from collections import deque
+
+try:
+    import redis
+except ModuleNotFoundError:  # optional, nur für REDIS_URL nötig
+    redis = None
 
 ALLOWED_WINDOW = 300  # 5 Minuten
 MAX_RUNS = 3  # max. 3 Analysen pro 5 Min.
+REDIS_URL = os.getenv("REDIS_URL")
 
+logger = logging.getLogger(__name__)
 
-try:
-    import markdown
-
-    # Try to import linkify extension for auto-linking plain URLs
-    try:
-        import markdown_linkify
 
-        linkify_available = True
-    except ImportError:
-        linkify_available = False
+@st.cache_resource(show_spinner=False)
+def get_redis():
+    """Shared Redis client for rate limiting across worker processes, if configured"""
+    if not REDIS_URL:
+        return None
+    if redis is None:
+        logger.warning(
+            "REDIS_URL ist gesetzt, aber das Paket 'redis' fehlt; "
+            "Rate-Limit gilt nur pro Session."
+        )
+        return None
+    # Kurze Timeouts: bei Redis-Ausfall lieber schnell aufs Session-Limit zurückfallen
+    return redis.Redis.from_url(REDIS_URL, socket_connect_timeout=2, socket_timeout=2)
 
-    def md_to_html(md_text: str) -> str:
-        exts = ["extra", "tables", "sane_lists"]
-        if linkify_available:
-            exts.append("linkify")
-        # Auto-link bare URLs via pymdown-extensions if available
-        try:
-            import pymdownx  # noqa: F401  # only to confirm it's installed
 
-            exts.append("pymdownx.magiclink")
-        except Exception:
-            pass
-        return markdown.markdown(md_text, extensions=exts, output_format="html5")
+@st.cache_resource(show_spinner=False)
+def get_markdown_parser():
+    """mistune parser, built once per process instead of on every rerun"""
+    # mistune: deutlich schneller als python-markdown; "url" verlinkt nackte URLs
+    return mistune.create_markdown(
+        escape=False, plugins=["table", "strikethrough", "url"]
+    )
 
-except ModuleNotFoundError:
-    # Fallback to markdown2 (ensure it's in requirements.txt) – supports tables via 'tables' extra
-    import markdown2
 
-    def md_to_html(md_text: str) -> str:
-        return markdown2.markdown(
-            md_text, extras=["tables", "fenced-code-blocks", "autolink"]
-        )
+def md_to_html(md_text: str) -> str:
+    return get_markdown_parser()(md_text)
+
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def md_to_html_cached(md_text: str) -> str:
+    # st.cache_data statt lru_cache: das Modul wird bei jedem Rerun neu ausgeführt
+    return md_to_html(md_text)
+
+
+def _can_run_redis(r, user, now):
+    # Rolling Window als Sorted Set: Score = Zeitstempel eines Laufs.
+    # Eintragen und Zählen in einem MULTI, damit parallele Worker nicht beide
+    # denselben letzten freien Platz sehen; Überzählige nehmen sich wieder raus.
+    key = f"ratelimit:{user}"
+    member = f"{now}:{uuid.uuid4().hex}"
+    pipe = r.pipeline(transaction=True)
+    pipe.zremrangebyscore(key, 0, now - ALLOWED_WINDOW)
+    pipe.zadd(key, {member: now})
+    pipe.zcard(key)
+    pipe.zrange(key, 0, 0, withscores=True)
+    pipe.expire(key, ALLOWED_WINDOW)
+    _, _, count, oldest, _ = pipe.execute()
+    if count > MAX_RUNS:
+        r.zrem(key, member)
+        wait = int(ALLOWED_WINDOW - (now - oldest[0][1]))
+        return False, wait
+    return True, 0
 
 
 def can_run(user):
     now = time.time()
-    runs = st.session_state.get("runs", {}).get(user, [])
-    runs = [t for t in runs if now - t < ALLOWED_WINDOW]
+    r = get_redis()
+    if r is not None:
+        try:
+            return _can_run_redis(r, user, now)
+        except redis.exceptions.RedisError as e:
+            logger.warning(
+                "Redis-Rate-Limit nicht verfügbar, nutze Session-Limit: %s", e
+            )
+
+    runs = st.session_state.setdefault("runs", {}).setdefault(
+        user, deque(maxlen=MAX_RUNS)
+    )
+    # Abgelaufene Zeitstempel vorne abräumen (älteste stehen links)
+    while runs and now - runs[0] >= ALLOWED_WINDOW:
+        runs.popleft()
     if len(runs) >= MAX_RUNS:
         wait = int(ALLOWED_WINDOW - (now - runs[0]))
         return False, wait
     runs.append(now)
-    st.session_state.setdefault("runs", {})[user] = runs
     return True, 0
 
 
 # ---------- Database Functions ----------
 
+DB_PATH = "analysis_history.db"
+PDF_DIR = os.getenv("PDF_DIR", "pdfs")  # PDFs liegen als Dateien neben der DB
+
+
+@st.cache_resource(show_spinner=False)
+def get_db():
+    """Process-wide SQLite connection plus the lock that serializes its use
+
+    Streamlit serves sessions (and the PDF worker) from several threads, so
+    the connection is shared with check_same_thread=False and guarded.
+    """
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    # Greift nur bei neu angelegter DB; bestehende behalten ihre Seitengröße
+    conn.execute("PRAGMA page_size=8192")
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=268435456")  # 256 MiB
+    conn.execute("PRAGMA cache_size=-20000")  # ~20 MB Page-Cache
+    # Planer-Statistiken bei jedem Verbindungsaufbau auffrischen: 0x10002 prüft
+    # alle Tabellen, nicht nur zuvor abgefragte. Erst ab SQLite 3.46 ist das
+    # dank analysis_limit günstig, ältere Versionen lassen es aus.
+    if sqlite3.sqlite_version_info >= (3, 46, 0):
+        conn.execute("PRAGMA optimize=0x10002")
+    return conn, threading.Lock()
+
+
+@contextmanager
+def db_cursor(db=None):
+    """Cursor on the shared connection; commits on success, rolls back on error
+
+    Pass db=get_db() when calling from a worker thread (no Streamlit context).
+    """
+    conn, lock = db or get_db()
+    with lock:
+        c = conn.cursor()
+        try:
+            yield c
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            c.close()
+
 
+@st.cache_resource(show_spinner=False)
 def init_database():
-    """Initialize SQLite database for analysis history"""
-    conn = sqlite3.connect("analysis_history.db")
-    c = conn.cursor()
-    c.execute(
+    """Initialize SQLite database for analysis history (once per process)"""
+    with db_cursor() as c:
+        c.execute(
+            """
+            CREATE TABLE IF NOT EXISTS analyses (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                date TEXT NOT NULL,
+                time TEXT NOT NULL,
+                analysis_type TEXT NOT NULL,
+                input_value TEXT NOT NULL,
+                perplexity_tokens INTEGER DEFAULT 0,
+                openrouter_tokens INTEGER DEFAULT 0,
+                total_cost_eur REAL DEFAULT 0.0,
+                pdf_data BLOB,
+                analysis_md TEXT,
+                pdf_path TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
         """
-        CREATE TABLE IF NOT EXISTS analyses (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            date TEXT NOT NULL,
-            time TEXT NOT NULL,
-            analysis_type TEXT NOT NULL,
-            input_value TEXT NOT NULL,
-            perplexity_tokens INTEGER DEFAULT 0,
-            openrouter_tokens INTEGER DEFAULT 0,
-            total_cost_eur REAL DEFAULT 0.0,
-            pdf_data BLOB,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
-    """
-    )
 
-    # Add new columns if they don't exist (for backward compatibility)
-    try:
-        c.execute("ALTER TABLE analyses ADD COLUMN perplexity_tokens INTEGER DEFAULT 0")
-    except:
-        pass
-    try:
-        c.execute("ALTER TABLE analyses ADD COLUMN openrouter_tokens INTEGER DEFAULT 0")
-    except:
-        pass
-    try:
-        c.execute("ALTER TABLE analyses ADD COLUMN total_cost_eur REAL DEFAULT 0.0")
-    except:
-        pass
-    try:
-        c.execute("ALTER TABLE analyses ADD COLUMN pdf_data BLOB")
-    except:
-        pass
+        # Add new columns if they don't exist (for backward compatibility)
+        columns = {row[1] for row in c.execute("PRAGMA table_info(analyses)")}
+        for name, ddl in (
+            ("perplexity_tokens", "INTEGER DEFAULT 0"),
+            ("openrouter_tokens", "INTEGER DEFAULT 0"),
+            ("total_cost_eur", "REAL DEFAULT 0.0"),
+            ("pdf_data", "BLOB"),
+            ("analysis_md", "TEXT"),
+            ("pdf_path", "TEXT"),
+        ):
+            if name not in columns:
+                c.execute(f"ALTER TABLE analyses ADD COLUMN {name} {ddl}")
+
+        # Result cache for identical analysis requests (see fetch_analysis)
+        c.execute(
+            """
+            CREATE TABLE IF NOT EXISTS analysis_cache (
+                cache_key TEXT PRIMARY KEY,
+                analysis_md TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """
+        )
 
-    # Clear existing data for fresh start (remove this after first deployment)
-    # c.execute('DELETE FROM analyses')  # Commented out to preserve data
+        # History is listed newest first; id is the rowid, created_at gets its own index
+        c.execute(
+            "CREATE INDEX IF NOT EXISTS idx_analyses_created_at ON analyses(created_at)"
+        )
 
-    conn.commit()
-    conn.close()
+        # Clear existing data for fresh start (remove this after first deployment)
+        # c.execute('DELETE FROM analyses')  # Commented out to preserve data
 
 
 def log_analysis(
-    analysis_type, input_value, px_tokens, or_tokens, total_cost_eur, pdf_data
+    analysis_type, input_value, px_tokens, or_tokens, total_cost_eur, analysis_md
 ):
-    """Log a completed analysis to the database"""
-    conn = sqlite3.connect("analysis_history.db")
-    c = conn.cursor()
+    """Log a completed analysis to the database and return its ID"""
     now = datetime.now()
     date = now.strftime("%Y-%m-%d")
     time = now.strftime("%H:%M:%S")
 
-    c.execute(
-        """
-        INSERT INTO analyses (date, time, analysis_type, input_value, perplexity_tokens, openrouter_tokens, total_cost_eur, pdf_data)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-    """,
-        (
-            date,
-            time,
-            analysis_type,
-            input_value,
-            px_tokens,
-            or_tokens,
-            total_cost_eur,
-            pdf_data,
-        ),
-    )
-    conn.commit()
-    conn.close()
+    with db_cursor() as c:
+        c.execute(
+            """
+            INSERT INTO analyses (date, time, analysis_type, input_value, perplexity_tokens, openrouter_tokens, total_cost_eur, analysis_md)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+            (
+                date,
+                time,
+                analysis_type,
+                input_value,
+                px_tokens,
+                or_tokens,
+                total_cost_eur,
+                analysis_md,
+            ),
+        )
+        analysis_id = c.lastrowid
+    get_total_stats.clear()
+    return analysis_id
+
+
+def store_pdf(analysis_id, pdf_data, db=None):
+    """Write a rendered PDF to PDF_DIR and attach its path to the analysis"""
+    os.makedirs(PDF_DIR, exist_ok=True)
+    pdf_path = os.path.join(PDF_DIR, f"{analysis_id}.pdf")
+    tmp_path = pdf_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(pdf_data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, pdf_path)  # nie halbe Dateien ausliefern
+    # Alten BLOB erst löschen, wenn die Datei vollständig auf der Platte liegt
+    if os.path.getsize(pdf_path) != len(pdf_data):
+        raise OSError(f"PDF für Analyse {analysis_id} unvollständig geschrieben")
+
+    with db_cursor(db) as c:
+        c.execute(
+            "UPDATE analyses SET pdf_path = ?, pdf_data = NULL WHERE id = ?",
+            (pdf_path, analysis_id),
+        )
 
 
-def get_analysis_history():
-    """Get all analysis history from database"""
-    conn = sqlite3.connect("analysis_history.db")
-    df = pd.read_sql_query(
-        """
-        SELECT id, date, time, analysis_type, input_value
-        FROM analyses 
-        ORDER BY id DESC
-    """,
-        conn,
-    )
-    conn.close()
-    return df
+HISTORY_PAGE_SIZE = 50
 
 
+def get_analysis_history(offset=0, limit=HISTORY_PAGE_SIZE):
+    """Get one page of analysis history (PDFs are loaded/rendered on demand)"""
+    with db_cursor() as c:
+        c.execute(
+            """
+            SELECT id, date, time, analysis_type, input_value,
+                   pdf_path IS NOT NULL OR pdf_data IS NOT NULL
+                       OR analysis_md IS NOT NULL AS has_pdf
+            FROM analyses 
+            ORDER BY id DESC
+            LIMIT ? OFFSET ?
+        """,
+            (limit, offset),
+        )
+        return c.fetchall()
+
+
+def get_analysis_count():
+    """Get the number of logged analyses"""
+    with db_cursor() as c:
+        c.execute("SELECT COUNT(*) FROM analyses")
+        return c.fetchone()[0]
+
+
+@st.cache_data(show_spinner=False)
 def get_total_stats():
-    """Get total tokens and costs from database"""
-    conn = sqlite3.connect("analysis_history.db")
-    c = conn.cursor()
-    c.execute(
+    """Get total tokens and costs from database (cached until the next log_analysis)"""
+    with db_cursor() as c:
+        c.execute(
+            """
+            SELECT 
+                COALESCE(SUM(perplexity_tokens), 0) as total_px_tokens,
+                COALESCE(SUM(openrouter_tokens), 0) as total_or_tokens,
+                COALESCE(SUM(total_cost_eur), 0) as total_cost_eur
+            FROM analyses
         """
-        SELECT 
-            COALESCE(SUM(perplexity_tokens), 0) as total_px_tokens,
-            COALESCE(SUM(openrouter_tokens), 0) as total_or_tokens,
-            COALESCE(SUM(total_cost_eur), 0) as total_cost_eur
-        FROM analyses
-    """
-    )
-    result = c.fetchone()
-    conn.close()
+        )
+        result = c.fetchone()
 
     if result:
         total_tokens = result[0] + result[1]
@@ -331,33 +500,431 @@ def get_total_stats():
 
 
 def get_pdf_from_db(analysis_id):
-    """Get PDF data from database by analysis ID"""
-    conn = sqlite3.connect("analysis_history.db")
-    c = conn.cursor()
-    c.execute("SELECT pdf_data FROM analyses WHERE id = ?", (analysis_id,))
-    result = c.fetchone()
-    conn.close()
+    """Get PDF data by analysis ID (moves legacy BLOBs to PDF_DIR on first access)"""
+    with db_cursor() as c:
+        c.execute(
+            "SELECT pdf_path, pdf_data FROM analyses WHERE id = ?", (analysis_id,)
+        )
+        result = c.fetchone()
+
+    if not result:
+        return None
+    pdf_path, pdf_data = result
+    if pdf_path and os.path.exists(pdf_path):
+        with open(pdf_path, "rb") as f:
+            return f.read()
+    if pdf_data:
+        try:
+            store_pdf(analysis_id, pdf_data)
+        except OSError as e:  # BLOB bleibt dann in der DB
+            logger.warning(
+                "PDF %s nicht nach %s verschoben: %s", analysis_id, PDF_DIR, e
+            )
+        return pdf_data
+    return None
+
+
+def get_analysis_markdown(analysis_id):
+    """Get the stored markdown of an analysis (source for on-demand PDFs)"""
+    with db_cursor() as c:
+        c.execute("SELECT analysis_md FROM analyses WHERE id = ?", (analysis_id,))
+        result = c.fetchone()
 
     if result and result[0]:
         return result[0]
     return None
 
 
+def get_cached_analysis(cache_key):
+    """Get a cached analysis markdown if it is younger than ANALYSIS_CACHE_TTL"""
+    with db_cursor() as c:
+        c.execute(
+            """
+            SELECT analysis_md FROM analysis_cache
+            WHERE cache_key = ? AND created_at >= datetime('now', ?)
+        """,
+            (cache_key, f"-{ANALYSIS_CACHE_TTL} seconds"),
+        )
+        result = c.fetchone()
+
+    if result:
+        return result[0]
+    return None
+
+
+def store_cached_analysis(cache_key, analysis_md):
+    """Store (or refresh) an analysis result in the cache and drop expired entries"""
+    with db_cursor() as c:
+        c.execute(
+            """
+            INSERT OR REPLACE INTO analysis_cache (cache_key, analysis_md, created_at)
+            VALUES (?, ?, CURRENT_TIMESTAMP)
+        """,
+            (cache_key, analysis_md),
+        )
+        # Abgelaufene Einträge werden nie mehr gelesen, nur noch Ballast
+        c.execute(
+            "DELETE FROM analysis_cache WHERE created_at < datetime('now', ?)",
+            (f"-{ANALYSIS_CACHE_TTL} seconds",),
+        )
+
+
 # ---------- Helper to load prompt templates ----------
 
 
-def load_prompts():
-    namespace = {}
-    with open("prompts.txt", "r", encoding="utf-8") as f:
-        exec(f.read(), namespace)
+PROMPTS_PATH = "prompts.toml"
+
+
+@st.cache_resource(show_spinner=False, max_entries=1)
+def load_prompts(mtime):
+    """Parse prompts.toml once per file version (mtime is the cache key, no exec)"""
+    with open(PROMPTS_PATH, "rb") as f:
+        templates = tomllib.load(f)
+    return {
+        "Firmenanalyse": templates.get("research_prompt1", ""),
+        "Absatzprofil": templates.get("research_prompt2", ""),
+        "Lieferantensuche": templates.get("research_prompt3", ""),
+    }
+
+
+prompts = load_prompts(os.path.getmtime(PROMPTS_PATH))
+
+# ---------- LLM API Helpers ----------
+
+PERPLEXITY_URL = "https://api.perplexity.ai/chat/completions"
+OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+
+
+# (Connect, Read) – Read gilt pro Socket-Read, beim Streaming also je Chunk
+API_TIMEOUT = (5, 120)
+
+
+@st.cache_resource(show_spinner=False)
+def get_http_session():
+    """Shared HTTP session so TCP/TLS connections are kept alive across analyses"""
+    session = requests.Session()
+    # POST ist nicht idempotent: urllib3 wiederholt nur Verbindungsfehler
+    adapter = HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=4,
+        max_retries=Retry(total=2, backoff_factor=0.3),
+    )
+    session.mount("https://", adapter)
+    session.headers.update({"Content-Type": "application/json"})
+    return session
+
+
+STREAM_UPDATE_EVERY = 20  # UI-Update alle N Chunks
+
+
+def post_chat_completion(url, api_key, payload, on_update=None):
+    """POST a streaming chat completion and assemble the SSE chunks
+
+    on_update(text) is called with the accumulated text every
+    STREAM_UPDATE_EVERY chunks. Returns a dict shaped like the non-streaming
+    response (choices/usage/citations) so callers don't need to care.
+    """
+    response = get_http_session().post(
+        url,
+        headers={"Authorization": f"Bearer {api_key}"},
+        data=json_dumps({**payload, "stream": True}),
+        stream=True,
+        timeout=API_TIMEOUT,
+    )
+    with response:
+        response.raise_for_status()
+        parts = []
+        usage = {}
+        citations = None
+        for line in response.iter_lines():
+            # SSE: nur "data:"-Zeilen, Kommentare/Keep-alives überspringen
+            if not line.startswith(b"data:"):
+                continue
+            data = line[5:].strip()
+            if data == b"[DONE]":
+                break
+            chunk = json_loads(data)
+            if "error" in chunk:
+                raise RuntimeError(f"API-Fehler im Stream: {chunk['error']}")
+
+            choices = chunk.get("choices") or [{}]
+            delta = (choices[0].get("delta") or {}).get("content")
+            if delta:
+                parts.append(delta)
+                if on_update and len(parts) % STREAM_UPDATE_EVERY == 0:
+                    on_update("".join(parts))
+            if chunk.get("usage"):
+                usage = chunk["usage"]
+            if chunk.get("citations"):
+                citations = chunk["citations"]
+
+    content = "".join(parts)
+    if on_update:
+        on_update(content)
     return {
-        "Firmenanalyse": namespace.get("research_prompt1", ""),
-        "Absatzprofil": namespace.get("research_prompt2", ""),
-        "Lieferantensuche": namespace.get("research_prompt3", ""),
+        "choices": [{"message": {"content": content}}],
+        "usage": usage,
+        "citations": citations,
     }
 
 
-prompts = load_prompts()
+_MD_HEADING_RE = re.compile(r"^#{1,3} ", re.M)
+_MD_TABLE_RE = re.compile(r"^\|?\s*:?-{3,}:?\s*\|", re.M)
+
+
+def looks_like_markdown(text):
+    """Cheap probe whether text is already usable Markdown (headings + lists/tables)"""
+    if not _MD_HEADING_RE.search(text):
+        return False
+    bullets = text.count("\n- ") + text.count("\n* ")
+    return bullets >= 3 or bool(_MD_TABLE_RE.search(text))
+
+
+MAX_CITATION_LINKS = 25
+_ESC_TABLE = str.maketrans("", "", "\x1b")  # ANSI-Escape-Zeichen entfernen
+
+FORMAT_PROMPT = """
+Du bist ein erfahrener Redakteur und Markdown‑Profi.
+
+### Aufgabe:
+Formatiere jeden der folgenden Textabschnitte als einheitliches, elegantes Markdown mit:
+- Überschriften (## / ###), vorhandene Abschnittsüberschriften beibehalten
+- Bulletpoints, wo sinnvoll
+- echten Markdown‑Tabellen
+- **kein** HTML, **keine** ASCII‑Grafik, **keine** Farben
+
+### Antwortformat:
+Ausschließlich JSON der Form {{"sections": ["...", "..."]}} – genau ein
+formatierter Abschnitt pro Eingabe-Abschnitt, gleiche Anzahl und Reihenfolge.
+
+### Abschnitte (JSON-Liste):
+---
+{sections_json}
+"""
+
+_MD_SECTION_RE = re.compile(r"^(?=## )", re.M)
+
+
+def format_sections(text):
+    """Let GPT‑4o reformat only the ``##`` sections that aren't clean Markdown yet
+
+    Clean sections are passed through untouched, so their tokens are never
+    sent to OpenRouter. Returns (markdown, or_tokens).
+    """
+    sections = [s.strip() for s in _MD_SECTION_RE.split(text) if s.strip()]
+    todo = [i for i, sec in enumerate(sections) if not looks_like_markdown(sec)]
+    logger.debug(
+        "Formatierung: %d von %d Abschnitten an OpenRouter", len(todo), len(sections)
+    )
+    if not todo:
+        return "\n\n".join(sections), 0
+
+    sections_json = json_dumps([sections[i] for i in todo]).decode()
+    or_payload = {
+        "model": OPENROUTER_MODEL,
+        "messages": [
+            {"role": "system", "content": "Formatierungs‑Experte"},
+            {
+                "role": "user",
+                "content": FORMAT_PROMPT.format(sections_json=sections_json),
+            },
+        ],
+        "response_format": {"type": "json_object"},
+    }
+    or_json = post_chat_completion(OPENROUTER_URL, OPENROUTER_API_KEY, or_payload)
+    or_tokens = or_json.get("usage", {}).get("total_tokens", 0)
+
+    try:
+        formatted = json_loads(or_json["choices"][0]["message"]["content"])
+        formatted = formatted["sections"]
+    except (json.JSONDecodeError, KeyError, TypeError):
+        formatted = None
+    # Bei unbrauchbarer Antwort bleiben die Originalabschnitte stehen
+    if isinstance(formatted, list) and len(formatted) == len(todo):
+        for i, section in zip(todo, formatted):
+            sections[i] = str(section).strip()
+    return "\n\n".join(sections), or_tokens
+
+
+def analysis_cache_key(perplexity_prompt, search_period):
+    """Hash of everything that determines an analysis result
+
+    The rendered prompt already contains the template text and the user input,
+    so editing prompts.toml (or the format prompt/models) invalidates old entries.
+    """
+    raw = "|".join(
+        [
+            PERPLEXITY_MODEL,
+            OPENROUTER_MODEL,
+            search_period,
+            perplexity_prompt,
+            FORMAT_PROMPT,
+        ]
+    )
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def fetch_analysis(perplexity_prompt, search_period, on_update=None):
+    """Run Perplexity research + GPT‑4o formatting, served from cache if possible
+
+    on_update receives the partial research text while Perplexity streams.
+    Returns (analysis_md, px_tokens, or_tokens, from_cache).
+    """
+    cache_key = analysis_cache_key(perplexity_prompt, search_period)
+    cached_md = get_cached_analysis(cache_key)
+    if cached_md is not None:
+        return cached_md, 0, 0, True
+
+    # ---- Perplexity (Recherche) ---- (Back to original working version)
+    px_payload = {
+        "model": PERPLEXITY_MODEL,
+        "messages": [{"role": "user", "content": perplexity_prompt}],
+        "search_scope": "recent",
+        "search_period": search_period,
+    }
+
+    px_json = post_chat_completion(
+        PERPLEXITY_URL, PERPLEXITY_API_KEY, px_payload, on_update
+    )
+    px_content = px_json["choices"][0]["message"]["content"].strip()
+    px_tokens = px_json.get("usage", {}).get("total_tokens", 0)
+
+    # ---- Zitat‑URLs (werden erst nach der Formatierung angehängt) ----
+    sources_md = ""
+    citations = px_json.get("citations", None)
+    if isinstance(citations, list):
+        # Reihenfolge erhalten, Duplikate entfernen, auf MAX_CITATION_LINKS kappen
+        links = list(
+            dict.fromkeys(
+                u for c in citations if isinstance(c, dict) and (u := c.get("url"))
+            )
+        )[:MAX_CITATION_LINKS]
+        if links:
+            px_content = px_content.translate(_ESC_TABLE)
+            sources_md = "\n\n### Webseiten-Quellen:\n" + "\n".join(
+                f"- [{u}]({u})" for u in links
+            )
+
+    # ---- GPT‑4o (Formatierung) ---- nur Abschnitte ohne sauberes Markdown
+    analysis_md, or_tokens = format_sections(px_content)
+    analysis_md += sources_md
+
+    store_cached_analysis(cache_key, analysis_md)
+    return analysis_md, px_tokens, or_tokens, False
+
+
+# ---------- PDF Export ----------
+
+PDF_STYLE = """
+@page { size: A4 portrait; margin: 1.8cm; }
+body { font-family: Arial, sans-serif; font-size: 10pt; line-height: 1.45; }
+h1,h2,h3 { color: #222; margin-top: 1.2em; }
+table { width: 100%; table-layout: fixed; border-collapse: collapse; font-size: 9pt; margin: 0.8em 0; }
+th,td { border: 1px solid #ccc; padding: 4px 6px; text-align: left; word-wrap: break-word; overflow-wrap: anywhere; hyphens: auto; }
+a { color: #0044cc; text-decoration: underline; }
+a:visited { color: #660099; }
+"""
+
+
+@st.cache_resource(show_spinner=False)
+def get_pdf_font_config():
+    """WeasyPrint font configuration shared by all PDF renders"""
+    return FontConfiguration()
+
+
+@st.cache_resource(show_spinner=False)
+def get_pdf_stylesheet():
+    """Parse the PDF stylesheet once per process instead of on every export"""
+    return CSS(string=PDF_STYLE, font_config=get_pdf_font_config())
+
+
+@st.cache_resource(show_spinner=False)
+def get_pdf_image_cache():
+    """WeasyPrint image cache shared by all PDF renders"""
+    return {}
+
+
+# Dokumentrahmen um den konvertierten Body (Styles kommen aus PDF_STYLE)
+HTML_SHELL_PRE = "<html><head><meta charset='utf-8'></head><body>\n"
+HTML_SHELL_POST = "\n</body></html>"
+
+
+def build_html_template(html_body):
+    """Wrap converted analysis HTML into a full document"""
+    return HTML_SHELL_PRE + html_body + HTML_SHELL_POST
+
+
+def render_pdf(html_body, stylesheet, font_config, image_cache):
+    """Render an HTML body fragment to PDF bytes"""
+    html_template = build_html_template(html_body)
+    # Explizites Encoding statt Zeichensatz-Erkennung (greift bei Byte-Input)
+    return HTML(string=html_template, base_url=".", encoding="utf-8").write_pdf(
+        stylesheets=[stylesheet],
+        font_config=font_config,
+        cache=image_cache,
+        optimize_images=True,
+    )
+
+
+@st.cache_resource(show_spinner=False)
+def get_pdf_executor():
+    """Single PDF worker so WeasyPrint doesn't block the script thread
+
+    One worker on purpose: all renders share the FontConfiguration, stylesheet
+    and image cache, and those are not safe to use from two threads at once.
+    """
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="pdf")
+
+
+def _render_and_store_pdf(analysis_id, db, html_body, *render_args):
+    pdf_data = render_pdf(html_body, *render_args)
+    store_pdf(analysis_id, pdf_data, db)
+    return pdf_data
+
+
+@st.cache_resource(show_spinner=False)
+def warm_up_pdf_renderer():
+    """Render a throwaway PDF once per process in the background
+
+    Loads fonts and fills the font cache while the first analysis is still
+    waiting on the LLM APIs, so the first real export doesn't pay for it.
+    """
+    return get_pdf_executor().submit(
+        render_pdf,
+        "<p></p>",
+        get_pdf_stylesheet(),
+        get_pdf_font_config(),
+        get_pdf_image_cache(),
+    )
+
+
+def submit_pdf_render(analysis_id, md_text):
+    """Start the PDF render for a logged analysis in the background
+
+    Cached Streamlit resources are resolved here, on the script thread; the
+    worker only runs WeasyPrint and writes the bytes to the analysis row.
+    """
+    return get_pdf_executor().submit(
+        _render_and_store_pdf,
+        analysis_id,
+        get_db(),
+        md_to_html_cached(md_text),
+        get_pdf_stylesheet(),
+        get_pdf_font_config(),
+        get_pdf_image_cache(),
+    )
+
+
+def get_or_render_pdf(analysis_id):
+    """Stored PDF of an analysis; rendered from its markdown and stored on first use"""
+    pdf_data = get_pdf_from_db(analysis_id)
+    if pdf_data is None:
+        analysis_md = get_analysis_markdown(analysis_id)
+        if analysis_md:
+            # Auch hier über den PDF-Worker, nie parallel zu einem anderen Render
+            pdf_data = submit_pdf_render(analysis_id, analysis_md).result()
+    return pdf_data
+
 
 # ---------- DATABASE INITIALIZATION ----------
 init_database()
@@ -367,14 +934,156 @@ if "analysis_markdown" not in st.session_state:
     st.session_state.analysis_markdown = ""
     st.session_state.token_info = ""
     st.session_state.analysis_title = ""
+    st.session_state.analysis_id = None
+    st.session_state.pdf_future = None
+    st.session_state.pdf_data = None
     st.session_state.analysis_running = False
     st.session_state.analysis_cancelled = False
     st.session_state.cancel_message = ""
     st.session_state.current_user_input = ""
     st.session_state.current_prompt_choice = ""
     st.session_state.current_search_period = "all"
-    st.session_state.last_prompt_choice = ""
-    st.session_state.last_period_label = ""
+    st.session_state.last_selection = None
+
+# ---------- UI FRAGMENTS ----------
+
+
+@st.fragment
+def analysis_inputs():
+    """Analysis type, period and input widgets
+
+    Changing a selector or typing reruns only this fragment instead of the
+    whole page (header stats, results, history table). The current values are
+    read from st.session_state by the start handler.
+    """
+    # Input fields side by side
+    col1, col2 = st.columns(2)
+
+    with col1:
+        prompt_choice = st.selectbox(
+            "Analyse-Typ",
+            ["Firmenanalyse", "Absatzprofil", "Lieferantensuche"],
+            key="prompt_choice",
+        )
+
+    with col2:
+        period_label = st.selectbox(
+            "Analysezeitraum",
+            [
+                "Letzter Tag",
+                "Letzte Woche",
+                "Letzter Monat",
+                "Letztes Jahr",
+                "Alle Zeiträume",
+            ],
+            index=4,
+            key="period_choice",
+        )
+
+    # Neue Auswahl -> Ergebnisse der alten verwerfen (ein Tupel-Vergleich pro Rerun)
+    selection = (prompt_choice, period_label)
+    if st.session_state.get("last_selection") != selection:
+        had_results = bool(st.session_state.analysis_markdown)
+        st.session_state.update(
+            {
+                "analysis_markdown": "",
+                "token_info": "",
+                "analysis_title": "",
+                "analysis_id": None,
+                "pdf_future": None,
+                "pdf_data": None,
+                "analysis_running": False,
+                "analysis_cancelled": False,
+                "cancel_message": "",
+                "last_selection": selection,
+            }
+        )
+        if had_results:
+            # Ergebnisbereich liegt außerhalb des Fragments
+            st.rerun()
+
+    # Input field based on analysis type
+    if prompt_choice == "Firmenanalyse":
+        user_input = st.text_input("Unternehmensname", key="company")
+    elif prompt_choice == "Absatzprofil":
+        user_input = st.text_input("Produktbeschreibung", key="product")
+    elif prompt_choice == "Lieferantensuche":
+        # Label wie gewünscht beibehalten
+        user_input = st.text_input(
+            "Beschreibung Einkaufsbedarf", key="sourcing_description"
+        )
+
+    st.session_state.pending_user_input = user_input
+
+
+PDF_POLL_INTERVAL = "1s"
+
+
+def take_pdf_result(pdf_future):
+    """Move a finished render from pdf_future to pdf_data (errors are shown once)"""
+    st.session_state.pdf_future = None
+    try:
+        st.session_state.pdf_data = pdf_future.result()
+    except Exception as e:
+        st.session_state.pdf_data = None
+        st.error(f"PDF-Generierung fehlgeschlagen: {e}")
+
+
+@st.fragment(run_every=PDF_POLL_INTERVAL)
+def pdf_render_status(analysis_md, title):
+    """Poll a pending PDF render; only called while pdf_future is pending
+
+    Once the render is done the result is taken over and the app reruns once,
+    which also stops this timer; pdf_download_panel then shows the download.
+    """
+    pdf_future = st.session_state.get("pdf_future")
+    if pdf_future is not None and not pdf_future.done():
+        st.info("📄 PDF wird erstellt...")
+        return
+    if pdf_future is not None:
+        take_pdf_result(pdf_future)
+        if st.session_state.pdf_data is None:
+            return
+    # Ergebnis für den einen vollen Lauf wiederherstellen (tab2 leert es danach)
+    st.session_state.analysis_markdown = analysis_md
+    st.session_state.analysis_title = title
+    st.rerun()
+
+
+@st.fragment
+def pdf_download_panel(analysis_id, analysis_md, title):
+    """On-demand PDF export for the current analysis
+
+    The PDF is only rendered (in the background) once the user asks for it.
+    Clicking reruns only this fragment; while the render is pending the nested
+    pdf_render_status polls it, so the (long) analysis markdown above is not
+    re-sent to the browser every second. The analysis comes in as arguments:
+    Streamlit keeps those across fragment reruns, while the result fields in
+    session_state are cleared by tab2.
+    """
+    if st.session_state.get("pdf_future") is None and not st.session_state.get(
+        "pdf_data"
+    ):
+        if not st.button("📄 PDF erstellen", use_container_width=True):
+            return
+        st.session_state.pdf_future = submit_pdf_render(analysis_id, analysis_md)
+
+    pdf_future = st.session_state.get("pdf_future")
+    if pdf_future is not None:
+        if not pdf_future.done():
+            pdf_render_status(analysis_md, title)
+            return
+        take_pdf_result(pdf_future)
+
+    if st.session_state.get("pdf_data"):
+        st.download_button(
+            "📄 Analyse als PDF herunterladen",
+            st.session_state.pdf_data,
+            file_name=f"Analyse_{title.replace(' ', '_')}.pdf",
+            mime="application/pdf",
+            use_container_width=True,
+        )
+
 
 # ---------- UI SETUP ----------
 
@@ -455,40 +1164,9 @@ period_options = {
 tab1, tab2 = st.tabs(["🆕 Neue Analyse", "📊 Analyse Historie"])
 
 with tab1:
-    # Input fields directly in the tab
-    col1, col2 = st.columns(2)
-
-    with col1:
-        prompt_choice = st.selectbox(
-            "Analyse-Typ",
-            ["Firmenanalyse", "Absatzprofil", "Lieferantensuche"],
-            key="prompt_choice",
-        )
-
-    with col2:
-        period_label = st.selectbox(
-            "Analysezeitraum",
-            [
-                "Letzter Tag",
-                "Letzte Woche",
-                "Letzter Monat",
-                "Letztes Jahr",
-                "Alle Zeiträume",
-            ],
-            index=4,
-            key="period_choice",
-        )
-
-    # Input field based on analysis type
-    if prompt_choice == "Firmenanalyse":
-        user_input = st.text_input("Unternehmensname", key="company")
-    elif prompt_choice == "Absatzprofil":
-        user_input = st.text_input("Produktbeschreibung", key="product")
-    elif prompt_choice == "Lieferantensuche":
-        # Label wie gewünscht beibehalten
-        user_input = st.text_input(
-            "Beschreibung Einkaufsbedarf", key="sourcing_description"
-        )
+    # Selectors/input rerun only their fragment; buttons stay outside so a
+    # click still triggers (and can interrupt) a full script run
+    analysis_inputs()
 
     # Buttons side by side
     col_btn1, col_btn2 = st.columns(2)
@@ -524,36 +1202,21 @@ with tab1:
     if st.session_state.analysis_markdown and not st.session_state.analysis_running:
         st.markdown("---")
         st.markdown(f"### Analyse für: {st.session_state.analysis_title}")
+        if st.session_state.token_info:
+            st.caption(st.session_state.token_info)
         st.markdown(st.session_state.analysis_markdown, unsafe_allow_html=True)
 
-        # --- Markdown -> HTML mit Tabellensupport ---
-        html_body = md_to_html(st.session_state.analysis_markdown)
-
-        html_template = f"""
-        <html><head><meta charset='utf-8'><style>
-            @page {{ size: A4 portrait; margin: 1.8cm; }}
-            body {{ font-family: Arial, sans-serif; font-size: 10pt; line-height: 1.45; }}
-            h1,h2,h3 {{ color: #222; margin-top: 1.2em; }}
-            table {{ width: 100%; table-layout: fixed; border-collapse: collapse; font-size: 9pt; margin: 0.8em 0; }}
-            th,td {{ border: 1px solid #ccc; padding: 4px 6px; text-align: left; word-wrap: break-word; overflow-wrap: anywhere; hyphens: auto; }}
-            a {{ color: #0044cc; text-decoration: underline; }}
-            a:visited {{ color: #660099; }}
-        </style></head><body>
-        {html_body}
-        </body></html>"""
-        try:
-            pdf_data = HTML(string=html_template, base_url=".").write_pdf()
-            st.download_button(
-                "📄 Analyse als PDF herunterladen",
-                pdf_data,
-                file_name=f"Analyse_{st.session_state.analysis_title.replace(' ', '_')}.pdf",
-                mime="application/pdf",
-                use_container_width=True,
+        if st.session_state.analysis_id is not None:
+            pdf_download_panel(
+                st.session_state.analysis_id,
+                st.session_state.analysis_markdown,
+                st.session_state.analysis_title,
             )
-        except Exception as e:
-            st.error(f"PDF-Generierung fehlgeschlagen: {e}")
 
     # ---------- HANDLE ANALYSIS START ----------
+    prompt_choice = st.session_state.prompt_choice
+    period_label = st.session_state.period_choice
+    user_input = st.session_state.get("pending_user_input", "")
     if start_btn and user_input.strip():
         # Rate limiting check
         ok, wait = can_run(st.session_state.get("current_username", "anon"))
@@ -565,6 +1228,9 @@ with tab1:
         st.session_state.analysis_markdown = ""
         st.session_state.token_info = ""
         st.session_state.analysis_title = ""
+        st.session_state.analysis_id = None
+        st.session_state.pdf_future = None
+        st.session_state.pdf_data = None
         st.session_state.analysis_cancelled = False
         st.session_state.analysis_running = True
         st.session_state.cancel_message = ""
@@ -576,8 +1242,6 @@ with tab1:
     # ---------- RUN ANALYSIS ----------
     if st.session_state.analysis_running and not st.session_state.analysis_cancelled:
         try:
-            prompts = load_prompts()
-
             choice = st.session_state.current_prompt_choice
             inp = st.session_state.current_user_input
 
@@ -598,98 +1262,33 @@ with tab1:
                 st.session_state.analysis_running = False
                 st.rerun()
 
-            # ---- PERPLEXITY SEARCH ----
-            px_headers = {
-                "Authorization": f"Bearer {PERPLEXITY_API_KEY}",
-                "Content-Type": "application/json",
-            }
+            # PDF-Engine aufwärmen, während Perplexity recherchiert
+            warm_up_pdf_renderer()
 
-            # ---- Perplexity (Recherche) ---- (Back to original working version)
-            px_payload = {
-                "model": PERPLEXITY_MODEL,
-                "messages": [{"role": "user", "content": perplexity_prompt}],
-                "search_scope": "recent",
-                "search_period": st.session_state.current_search_period,
-            }
-
-            # API call in progress (debug info removed)
-
-            px_response = requests.post(
-                "https://api.perplexity.ai/chat/completions",
-                headers=px_headers,
-                json=px_payload,
+            # Live-Ausgabe der gestreamten Recherche
+            live_output = st.empty()
+            analysis_md, px_tokens, or_tokens, from_cache = fetch_analysis(
+                perplexity_prompt,
+                st.session_state.current_search_period,
+                on_update=live_output.markdown,
             )
-            px_response.raise_for_status()
-            px_json = px_response.json()
-            px_content = px_json["choices"][0]["message"]["content"].strip()
-            px_tokens = px_json.get("usage", {}).get("total_tokens", 0)
-
-            # ---- Zitat‑URLs anhängen ----
-            citations = px_json.get("citations", None)
-            if isinstance(citations, list):
-                links = [
-                    c.get("url")
-                    for c in citations
-                    if isinstance(c, dict) and c.get("url")
-                ]
-                if links:
-                    px_content = px_content.replace("\u001b", "").replace("\x1b", "")
-                    px_content += "\n\n### Webseiten-Quellen:\n" + "\n".join(
-                        f"- [{u}]({u})" for u in links
-                    )
 
             if st.session_state.analysis_cancelled:
                 st.session_state.analysis_running = False
                 st.session_state.cancel_message = "Analyse gestoppt"
                 st.rerun()
             else:
-                # Continue with OpenRouter analysis only if Perplexity was successful
-
-                # ---- GPT‑4o (Formatierung) ---- (Back to original working version)
-                format_prompt = f"""
-Du bist ein erfahrener Redakteur und Markdown‑Profi.
-
-### Aufgabe:
-Formatiere den folgenden Text als einheitliches, elegantes Markdown‑Dokument mit:
-- Überschriften (## / ###)
-- Bulletpoints, wo sinnvoll
-- echten Markdown‑Tabellen
-- **kein** HTML, **keine** ASCII‑Grafik, **keine** Farben
-
-### Text:
----
-{px_content}
-"""
-                or_headers = {
-                    "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-                    "Content-Type": "application/json",
-                }
-                or_payload = {
-                    "model": OPENROUTER_MODEL,
-                    "messages": [
-                        {"role": "system", "content": "Formatierungs‑Experte"},
-                        {"role": "user", "content": format_prompt},
-                    ],
-                }
-
-                or_response = requests.post(
-                    "https://openrouter.ai/api/v1/chat/completions",
-                    headers=or_headers,
-                    json=or_payload,
-                )
-                or_response.raise_for_status()
-                or_json = or_response.json()
-                analysis_md = or_json["choices"][0]["message"]["content"].strip()
-                or_tokens = or_json.get("usage", {}).get("total_tokens", 0)
-
                 # ---- Kosteninfo ----
                 cost_px = round(px_tokens / 1000 * PERPLEXITY_RATE, 4)
                 cost_or = round(or_tokens / 1000 * OPENROUTER_RATE, 4)
                 total_usd = cost_px + cost_or
                 eur_rate = 0.92  # Approx. conversion rate USD → EUR
                 total_eur = round(total_usd * eur_rate, 4)
+                cache_note = (
+                    "♻️ Ergebnis aus Cache (keine API-Kosten)\n\n" if from_cache else ""
+                )
                 token_info = (
-                    "🔢 Tokens\n"
+                    f"{cache_note}🔢 Tokens\n"
                     f"- Perplexity: {px_tokens}\n"
                     f"- OpenRouter: {or_tokens}\n"
                     f"\n"
@@ -705,34 +1304,17 @@ Formatiere den folgenden Text als einheitliches, elegantes Markdown‑Dokument m
                     False  # Stop analysis when results are ready
                 )
 
-                # Generate PDF for database storage
-                try:
-                    html_body = md_to_html(analysis_md)
-                    html_template = f"""
-                    <html><head><meta charset='utf-8'><style>
-                        @page {{ size: A4 portrait; margin: 1.8cm; }}
-                        body {{ font-family: Arial, sans-serif; font-size: 10pt; line-height: 1.45; }}
-                        h1,h2,h3 {{ color: #222; margin-top: 1.2em; }}
-                        table {{ width: 100%; table-layout: fixed; border-collapse: collapse; font-size: 9pt; margin: 0.8em 0; }}
-                        th,td {{ border: 1px solid #ccc; padding: 4px 6px; text-align: left; word-wrap: break-word; overflow-wrap: anywhere; hyphens: auto; }}
-                        a {{ color: #0044cc; text-decoration: underline; }}
-                        a:visited {{ color: #660099; }}
-                    </style></head><body>
-                    {html_body}
-                    </body></html>"""
-                    pdf_data = HTML(string=html_template, base_url=".").write_pdf()
-                except:
-                    pdf_data = None
-
                 # Log successful analysis to database
-                log_analysis(
+                analysis_id = log_analysis(
                     st.session_state.current_prompt_choice,
                     st.session_state.current_user_input,
                     px_tokens,
                     or_tokens,
                     total_eur,
-                    pdf_data,
+                    analysis_md,
                 )
+                # PDF wird erst auf Anforderung erzeugt (pdf_download_panel)
+                st.session_state.analysis_id = analysis_id
 
                 # Analysis completed successfully
                 st.session_state.analysis_running = False
@@ -755,66 +1337,59 @@ with tab2:
         st.session_state.analysis_running = False
 
     try:
-        history_df = get_analysis_history()
-
-        if len(history_df) > 0 and all(
-            col in history_df.columns
-            for col in ["id", "date", "time", "analysis_type", "input_value"]
-        ):
-            # Create custom table with clickable PDF icons
-            # Header row
-            col_pdf, col_id, col_datum, col_zeit, col_typ, col_eingabe = st.columns(
-                [0.5, 0.5, 1, 1, 1.2, 3]
+        total_analyses = get_analysis_count()
+        page_count = max(1, -(-total_analyses // HISTORY_PAGE_SIZE))
+        page = 1
+        if page_count > 1:
+            page = st.number_input(
+                f"Seite (von {page_count})",
+                min_value=1,
+                max_value=page_count,
+                value=1,
+                step=1,
+                key="history_page",
+            )
+        history_rows = get_analysis_history(offset=(page - 1) * HISTORY_PAGE_SIZE)
+
+        if history_rows:
+            # Eine Tabelle statt sechs st.columns pro Zeile; Auswahl → PDF-Download
+            ids, dates, times, types, inputs, has_pdfs = zip(*history_rows)
+            table = st.dataframe(
+                {
+                    "PDF": ["📄" if has_pdf else "-" for has_pdf in has_pdfs],
+                    "ID": ids,
+                    "Datum": dates,
+                    "Uhrzeit": times,
+                    "Analysetyp": types,
+                    "Eingabe": [i[:80] + "..." if len(i) > 80 else i for i in inputs],
+                },
+                hide_index=True,
+                use_container_width=True,
+                on_select="rerun",
+                selection_mode="single-row",
+                key=f"history_table_{page}",  # Auswahl gilt nur für diese Seite
             )
 
-            with col_pdf:
-                st.markdown("**PDF**")
-            with col_id:
-                st.markdown("**ID**")
-            with col_datum:
-                st.markdown("**Datum**")
-            with col_zeit:
-                st.markdown("**Uhrzeit**")
-            with col_typ:
-                st.markdown("**Analysetyp**")
-            with col_eingabe:
-                st.markdown("**Eingabe**")
-
-            st.markdown("---")
-
-            # Data rows
-            for _, row in history_df.iterrows():
-                analysis_id = row["id"]
-                pdf_data = get_pdf_from_db(analysis_id)
-
-                col_pdf, col_id, col_datum, col_zeit, col_typ, col_eingabe = st.columns(
-                    [0.5, 0.5, 1, 1, 1.2, 3]
-                )
-
-                with col_pdf:
-                    if pdf_data:
-                        st.markdown(
-                            f"""<a href="data:application/pdf;base64,{base64.b64encode(pdf_data).decode()}" download="Analyse_{analysis_id}_{row['analysis_type']}_{row['input_value'][:20].replace(' ', '_')}.pdf">
-                                <small>📄</small>
-                            </a>""",
-                            unsafe_allow_html=True,
-                        )
-                    else:
-                        st.write("-")
-
-                with col_id:
-                    st.write(str(analysis_id))
-                with col_datum:
-                    st.write(row["date"])
-                with col_zeit:
-                    st.write(row["time"])
-                with col_typ:
-                    st.write(row["analysis_type"])
-                with col_eingabe:
-                    st.write(
-                        row["input_value"][:80] + "..."
-                        if len(row["input_value"]) > 80
-                        else row["input_value"]
+            selected = table.selection.rows
+            if not selected:
+                st.caption("Zeile auswählen, um das PDF herunterzuladen.")
+            elif not has_pdfs[selected[0]]:
+                st.info("Für diese Analyse ist kein PDF verfügbar.")
+            else:
+                analysis_id, _, _, analysis_type, input_value, _ = history_rows[
+                    selected[0]
+                ]
+                # PDF erst laden/erzeugen, nachdem die Zeile ausgewählt wurde
+                with st.spinner("PDF wird erstellt..."):
+                    pdf_data = get_or_render_pdf(analysis_id)
+                if pdf_data is None:  # z.B. PDF-Datei gelöscht und kein Markdown
+                    st.info("Für diese Analyse ist kein PDF verfügbar.")
+                else:
+                    st.download_button(
+                        f"📄 Analyse {analysis_id} als PDF herunterladen",
+                        data=pdf_data,
+                        file_name=f"Analyse_{analysis_id}_{analysis_type}_{input_value[:20].replace(' ', '_')}.pdf",
+                        mime="application/pdf",
                     )
 
         else: